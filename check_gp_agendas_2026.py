@@ -1,10 +1,23 @@
+import argparse
+import copy
+import gzip
+import hashlib
+import http.client
 import json
 import os
+import random
 import sys
 import time
+import urllib.error
 import urllib.parse
-import urllib.request
-from datetime import datetime, timezone, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # optional speedup; the stdlib json path is always supported
 
 # --- CivicPlus endpoint + folder payload (Agendas -> 2026) ---
 URL = "https://www.cityofgalenapark-tx.gov/Admin/DocumentCenter/Home/Document_AjaxBinding?renderMode=0&loadSource=7"
@@ -23,7 +36,13 @@ FORM = {
     "sortOrder": "0",
 }
 
+# Steady state: once the folder size is known, fetch only the most recently
+# modified docs (a new upload lands on this page). If the reported total
+# differs from the stored one, main() falls back to a full FORM fetch.
+RECENT_FORM = {**FORM, "rowsPerPage": "10", "sortColumn": "DateModified", "sortOrder": "1"}
+
 STATE_FILE = "state.json"
+STATE_TMP_FILE = STATE_FILE + ".tmp"
 DISCORD_WEBHOOK_URL = os.environ.get("DISCORD_WEBHOOK_URL", "").strip()
 
 # Heartbeat only on manual runs (workflow sets this)
@@ -32,43 +51,79 @@ FORCE_NOTIFY = os.environ.get("FORCE_NOTIFY", "").strip() in ("1", "true", "TRUE
 # Daily 7pm CST message only on the "daily schedule" runs (workflow sets this)
 DAILY_CHECK = os.environ.get("DAILY_CHECK", "").strip() in ("1", "true", "TRUE", "yes", "YES")
 
-# America/Chicago handling without external deps:
-# We'll compute local time using system's UTC + an offset, plus a simple DST rule.
-# This is good enough for "7pm in Chicago" for automation purposes.
-def is_us_dst_chicago(dt_utc: datetime) -> bool:
+# Cron expression of the scheduled run that started us, if any (workflow sets this)
+DAILY_SCHEDULE = os.environ.get("DAILY_SCHEDULE", "").strip()
+
+# Local time for the daily 7pm message; zoneinfo reads the system tzdb, so
+# DST transitions follow the real rules.
+CHICAGO = ZoneInfo("America/Chicago")
+
+def scheduled_local_hour(schedule: str, dt_utc: datetime):
     """
-    Approx DST for America/Chicago:
-    - starts: 2nd Sunday in March at 2:00 local
-    - ends:   1st Sunday in November at 2:00 local
-    We evaluate boundaries in UTC approximately by converting candidate local times.
+    Chicago hour the given daily cron ("M H * * *", UTC) was *scheduled* for
+    today, regardless of how late the run actually started. None if unparsable.
     """
-    year = dt_utc.year
-
-    # Find 2nd Sunday in March
-    march = datetime(year, 3, 1, tzinfo=timezone.utc)
-    # weekday(): Mon=0...Sun=6; need Sunday=6
-    first_sunday_offset = (6 - march.weekday()) % 7
-    second_sunday = 1 + first_sunday_offset + 7
-    # 2:00 local CST (UTC-6) before switch => 08:00 UTC
-    dst_start_utc = datetime(year, 3, second_sunday, 8, 0, 0, tzinfo=timezone.utc)
-
-    # Find 1st Sunday in November
-    nov = datetime(year, 11, 1, tzinfo=timezone.utc)
-    first_sunday_offset = (6 - nov.weekday()) % 7
-    first_sunday = 1 + first_sunday_offset
-    # 2:00 local CDT (UTC-5) before switch => 07:00 UTC
-    dst_end_utc = datetime(year, 11, first_sunday, 7, 0, 0, tzinfo=timezone.utc)
-
-    return dst_start_utc <= dt_utc < dst_end_utc
-
-def chicago_now_from_utc(dt_utc: datetime) -> datetime:
-    # CST = UTC-6, CDT = UTC-5
-    offset_hours = -5 if is_us_dst_chicago(dt_utc) else -6
-    return (dt_utc + timedelta(hours=offset_hours)).replace(tzinfo=None)
-
-def http_post_json(url: str, form: dict) -> dict:
+    fields = schedule.split()
+    if len(fields) < 2 or not fields[1].isdigit():
+        return None
+    scheduled = dt_utc.replace(hour=int(fields[1]), minute=0, second=0, microsecond=0)
+    return scheduled.astimezone(CHICAGO).hour
+
+def json_loads(raw):
+    return orjson.loads(raw) if orjson else json.loads(raw)
+
+def json_dumps(obj) -> bytes:
+    # Compact either way: no indentation or spaces after separators.
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+# One keep-alive HTTPS connection per host, opened lazily and reused for the
+# whole run: retries in http_post_json and repeated Discord posts skip the
+# TCP + TLS handshake.
+_CONNECTIONS = {}
+
+def http_request(url: str, body: bytes, headers: dict, method: str = "POST"):
+    """
+    POST over a pooled connection. Returns (response, body bytes), with a
+    gzip-encoded body already decompressed.
+    Raises urllib.error.HTTPError on 4xx/5xx and on 3xx other than 304.
+    """
+    headers = {"Accept-Encoding": "gzip", **headers}
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path + ("?" + parts.query if parts.query else "")
+
+    conn = _CONNECTIONS.get(parts.netloc)
+    if conn is None:
+        conn = http.client.HTTPSConnection(parts.netloc, timeout=30)
+        _CONNECTIONS[parts.netloc] = conn
+
+    try:
+        conn.request(method, path, body=body, headers=headers)
+        resp = conn.getresponse()
+        raw = resp.read()
+    except Exception:
+        # Don't hand a half-used socket to the next caller.
+        conn.close()
+        _CONNECTIONS.pop(parts.netloc, None)
+        raise
+
+    if resp.headers.get("Content-Encoding", "").lower() == "gzip":
+        raw = gzip.decompress(raw)
+    # Redirects aren't followed; surface them rather than return their body.
+    if resp.status >= 400 or (300 <= resp.status < 400 and resp.status != 304):
+        raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, None)
+    return resp, raw
+
+def http_post_json(url: str, form: dict, validators: dict = None):
     """
     CivicPlus sometimes blocks datacenter IPs. Use browser-ish headers + retries.
+
+    If validators (the per-form slot from state["validators"]) is given, it
+    is sent as a conditional request and refreshed from the response.
+    Returns None when the folder is unchanged: either a 304, or (since
+    CivicPlus rarely honors validators on a POST) a body whose sha256
+    matches the last one seen.
     """
     data = urllib.parse.urlencode(form).encode("utf-8")
 
@@ -84,89 +139,192 @@ def http_post_json(url: str, form: dict) -> dict:
         "Origin": "https://www.cityofgalenapark-tx.gov",
         "Referer": "https://www.cityofgalenapark-tx.gov/DocumentCenter",
     }
+    if validators:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
 
     last_err = None
+    parse_failed = False
     for attempt in range(1, 6):
         try:
-            req = urllib.request.Request(url, data=data, method="POST", headers=headers)
-            with urllib.request.urlopen(req, timeout=30) as resp:
-                raw = resp.read().decode("utf-8", errors="replace")
-            return json.loads(raw)
+            resp, raw = http_request(url, data, headers)
+            if resp.status == 304:
+                return None
+            body_sha256 = hashlib.sha256(raw).hexdigest()
+            # The stored hash only ever comes from a body that parsed, so a
+            # match is the same good payload -- unless this loop just failed
+            # to parse these bytes, in which case don't trust it.
+            if validators is not None and not parse_failed and body_sha256 == validators.get("body_sha256"):
+                return None
+            # Parsed in one go rather than streamed: the hash check above needs
+            # the whole (decompressed) body first, and it is only a few KB.
+            try:
+                payload = json_loads(raw)
+            except ValueError:
+                parse_failed = True
+                raise
+            if not isinstance(payload, dict) or "Documents" not in payload:
+                # e.g. an HTML block page served with a 200
+                parse_failed = True
+                raise ValueError("CivicPlus response has no Documents list")
+            if validators is not None:
+                validators["etag"] = resp.headers.get("ETag", "")
+                validators["last_modified"] = resp.headers.get("Last-Modified", "")
+                validators["body_sha256"] = body_sha256
+            return payload
         except Exception as e:
             last_err = e
-            time.sleep(2 ** (attempt - 1))  # 1,2,4,8,16 sec
+            if attempt == 5:
+                break
+            # Full jitter (up to 1,2,4,8 sec) so concurrent runs don't retry in lockstep.
+            delay = random.uniform(0, min(2 ** (attempt - 1), 30))
+            if isinstance(e, urllib.error.HTTPError) and e.code in (429, 503):
+                retry_after = (e.headers.get("Retry-After") or "").strip()
+                if retry_after.isdigit():
+                    delay = min(float(retry_after), 30)
+            time.sleep(delay)
     raise last_err
 
 def load_state() -> dict:
+    state = {"seen_ids": [], "validators": {}}
     if os.path.exists(STATE_FILE):
-        with open(STATE_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {"seen_ids": []}
+        # Read bytes and hand them straight to the parser (no text layer).
+        with open(STATE_FILE, "rb") as f:
+            raw = f.read()
+        if raw.strip():
+            state.update(json_loads(raw))
+    return state
+
+def write_state_file(state: dict, path: str) -> None:
+    with open(path, "wb") as f:
+        f.write(json_dumps(state))
+        f.flush()
+        os.fsync(f.fileno())
 
 def save_state(state: dict) -> None:
-    with open(STATE_FILE, "w", encoding="utf-8") as f:
-        json.dump(state, f, ensure_ascii=False, indent=2)
+    # Write a temp file and swap it in, so a crash mid-write can't leave an
+    # empty state.json that the next run would treat as a first run.
+    write_state_file(state, STATE_TMP_FILE)
+    os.replace(STATE_TMP_FILE, STATE_FILE)
+
+def state_needs_save(state: dict, loaded_state: dict) -> bool:
+    """
+    The workflow commits state.json whenever it changes, so refreshed
+    validators alone don't justify a write: if CivicPlus bodies aren't
+    byte-stable they would commit on every run. Save when anything else
+    changed, or when a validator slot is filled for the first time.
+    """
+    def without_validators(d):
+        return {k: v for k, v in d.items() if k != "validators"}
+
+    if without_validators(state) != without_validators(loaded_state):
+        return True
+    loaded_validators = loaded_state.get("validators", {})
+    return any(
+        slot and not loaded_validators.get(name)
+        for name, slot in state.get("validators", {}).items()
+    )
 
 def extract_docs(payload: dict):
+    """
+    Returns (docs in server order, {id: doc} for docs that have an id).
+    Callers sort only what they emit or persist.
+    """
     docs = payload.get("Documents", []) or []
     extracted = []
+    by_id = {}
     for d in docs:
         doc_id = d.get("ID")
         name = d.get("DisplayName") or d.get("Name") or "(unnamed)"
         # Some installs include direct URLs, many don't. We'll alert with ID regardless.
         url = d.get("FileUrl") or d.get("Url") or ""
-        extracted.append({"id": doc_id, "name": name, "url": url})
-    extracted.sort(key=lambda x: (x["id"] if x["id"] is not None else 0, x["name"]))
-    return extracted
+        doc = {"id": doc_id, "name": name, "url": url}
+        extracted.append(doc)
+        if doc_id is not None:
+            by_id[doc_id] = doc
+    return extracted, by_id
 
 def discord_post(text: str):
     if not DISCORD_WEBHOOK_URL:
         print("DISCORD_WEBHOOK_URL not set; skipping Discord notify.")
         return
-    data = json.dumps({"content": text}).encode("utf-8")
-    req = urllib.request.Request(
-        DISCORD_WEBHOOK_URL,
-        data=data,
-        method="POST",
-        headers={"Content-Type": "application/json"},
-    )
-    with urllib.request.urlopen(req, timeout=30) as resp:
-        resp.read()
+    data = json_dumps({"content": text})
+    http_request(DISCORD_WEBHOOK_URL, data, {"Content-Type": "application/json"})
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Watch Galena Park Agendas -> 2026 for new documents.")
+    parser.add_argument("--quiet", action="store_true",
+                        help="never send heartbeat/init messages, even if FORCE_NOTIFY is set")
+    parser.add_argument("--no-daily", action="store_true",
+                        help="never send the daily 7pm message, even if DAILY_CHECK is set")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    force_notify = FORCE_NOTIFY and not args.quiet
+    daily_check = DAILY_CHECK and not args.no_daily
 
-def main():
     dt_utc = datetime.now(timezone.utc)
-    dt_local = chicago_now_from_utc(dt_utc)
+    dt_local = dt_utc.astimezone(CHICAGO)
     now_utc_str = dt_utc.strftime("%Y-%m-%d %H:%M UTC")
     now_local_str = dt_local.strftime("%Y-%m-%d %I:%M %p America/Chicago")
 
-    payload = http_post_json(URL, FORM)
-    docs = extract_docs(payload)
-
-    current_ids = [d["id"] for d in docs if d["id"] is not None]
-    current_set = set(current_ids)
-
     state = load_state()
-    seen = set(state.get("seen_ids", []))
+    loaded_state = copy.deepcopy(state)
+    seen_ids = state.get("seen_ids", [])
+
+    # Validators are kept per form: the recent page and the full listing are
+    # different bodies, and sharing one slot would rewrite state every switch.
+    validators = state.setdefault("validators", {})
+    partial = bool(seen_ids and state.get("expected_count"))
+    if partial:
+        payload = http_post_json(URL, RECENT_FORM, validators.setdefault("recent", {}))
+    else:
+        payload = http_post_json(URL, FORM, validators.setdefault("full", {}))
+    if partial and payload is not None and payload.get("TotalDocuments") != state["expected_count"]:
+        # Docs were added or removed: list the whole folder, unconditionally.
+        partial = False
+        validators["full"] = {}
+        payload = http_post_json(URL, FORM, validators["full"])
+
+    if payload is None:
+        # Unchanged since the last run: skip parsing, nothing can be new.
+        by_id = {}
+        current_ids = seen_ids
+        new_ids = set()
+    else:
+        docs, by_id = extract_docs(payload)
+        if partial:
+            # Only the newest page was fetched; older ids carry over.
+            current_ids = sorted(set(seen_ids).union(by_id))
+        else:
+            current_ids = sorted(by_id)
+            total = payload.get("TotalDocuments")
+            if isinstance(total, int):
+                state["expected_count"] = total
+            else:
+                state.pop("expected_count", None)
+        new_ids = set(current_ids) - set(seen_ids)
 
     # First run: initialize state (no "new doc" ping), but allow heartbeat if manual.
-    if not seen:
-        state["seen_ids"] = sorted(list(current_set))
+    if not seen_ids:
+        state["seen_ids"] = current_ids
         save_state(state)
 
         msg = (
             f"✅ GP Agendas 2026 watcher initialized.\n"
-            f"Total docs: {len(current_set)}\n"
+            f"Total docs: {len(current_ids)}\n"
             f"Checked: {now_utc_str} | {now_local_str}"
         )
         print(msg)
-        if FORCE_NOTIFY:
+        if force_notify:
             discord_post(msg)
         return
 
-    new_ids = current_set - seen
-
     if new_ids:
-        new_docs = [d for d in docs if d["id"] in new_ids]
+        new_docs = [by_id[i] for i in sorted(new_ids)]
         lines = []
         for doc in new_docs:
             if doc["url"]:
@@ -179,37 +337,52 @@ def main():
             + "\n".join(lines)
             + f"\n\nChecked: {now_utc_str} | {now_local_str}"
         )
-        discord_post(msg)
+        # Write the new state while the Discord post is in flight, but only
+        # swap it in after the notification succeeded.
+        state["seen_ids"] = current_ids
+        try:
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                posted = pool.submit(discord_post, msg)
+                staged = pool.submit(write_state_file, state, STATE_TMP_FILE)
+                posted.result()
+                staged.result()
+        except Exception:
+            # Alert not confirmed: drop the staged state so the next run retries.
+            if os.path.exists(STATE_TMP_FILE):
+                os.remove(STATE_TMP_FILE)
+            raise
+        os.replace(STATE_TMP_FILE, STATE_FILE)
         print(f"Found {len(new_docs)} new docs; notified.")
-
-        # Update state after successful notification
-        state["seen_ids"] = sorted(list(current_set))
-        save_state(state)
         return
 
     # No new documents
-    print(f"No new documents. Total docs: {len(current_set)}. Checked: {now_utc_str} | {now_local_str}")
+    print(f"No new documents. Total docs: {len(current_ids)}. Checked: {now_utc_str} | {now_local_str}")
 
     # Heartbeat on manual runs
-    if FORCE_NOTIFY:
+    if force_notify:
         discord_post(
             f"✅ GP Agendas 2026 check OK — no changes.\n"
-            f"Total docs: {len(current_set)}\n"
+            f"Total docs: {len(current_ids)}\n"
             f"Checked: {now_utc_str} | {now_local_str}"
         )
 
     # Daily 7pm America/Chicago message (only on the daily scheduled runs)
     # If workflow runs at the wrong UTC time (DST), we still only send if local hour==19.
-    if DAILY_CHECK and dt_local.hour == 19:
+    # A delayed run of the other daily cron can also land in that hour, so require
+    # the cron that started us to be the one scheduled for 7pm local time.
+    scheduled_hour = scheduled_local_hour(DAILY_SCHEDULE, dt_utc) if DAILY_SCHEDULE else None
+    if daily_check and dt_local.hour == 19 and scheduled_hour in (None, 19):
         discord_post(
             f"No new documents my leige.\n"
-            f"Total docs: {len(current_set)}\n"
+            f"Total docs: {len(current_ids)}\n"
             f"Checked: {now_utc_str} | {now_local_str}"
         )
 
-    # Always update state (even if unchanged) so it remains consistent
-    state["seen_ids"] = sorted(list(current_set))
-    save_state(state)
+    # Keep state consistent (e.g. removed docs), but don't rewrite the file
+    # when nothing that matters in it changed.
+    state["seen_ids"] = current_ids
+    if state_needs_save(state, loaded_state):
+        save_state(state)
 
 if __name__ == "__main__":
     try: